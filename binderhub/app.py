@@ -373,6 +373,15 @@ class BinderHub(Application):
         config=True,
         help="""The number of concurrent builds to allow."""
     )
+    concurrent_http_request_limit = Integer(
+        100,
+        config=True,
+        help="""The number of concurrent outgoing HTTP requests to allow.
+
+        Applies to the shared tornado AsyncHTTPClient used e.g. to resolve
+        refs with repo provider APIs. Requests beyond this limit are queued.
+        """
+    )
     executor_threads = Integer(
         5,
         config=True,
@@ -460,9 +469,15 @@ class BinderHub(Application):
 
     def init_pycurl(self):
         try:
-            AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+            AsyncHTTPClient.configure(
+                "tornado.curl_httpclient.CurlAsyncHTTPClient",
+                max_clients=self.concurrent_http_request_limit,
+            )
         except ImportError as e:
             self.log.debug("Could not load pycurl: %s\npycurl is recommended if you have a large number of users.", e)
+            AsyncHTTPClient.configure(
+                None, max_clients=self.concurrent_http_request_limit
+            )
         # set max verbosity of curl_httpclient at INFO
         # because debug-logging from curl_httpclient
         # includes every full request and response
@@ -7,25 +7,38 @@ control services and providers.
 Note: When adding a new repo provider, add it to the allowed values for
       repo providers in event-schemas/launch.json.
 """
+import asyncio
 from datetime import timedelta
+from functools import lru_cache, wraps
 import json
 import os
 import time
 import urllib.parse
 import re
 
-from prometheus_client import Gauge
+from prometheus_client import Counter, Gauge
 
-from tornado import gen
 from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
-from tornado.httputil import url_concat
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
 
-from traitlets import Dict, Unicode, Bool, default, List, observe
+from traitlets import Dict, Unicode, Bool, Float, Integer, default, List, observe
 from traitlets.config import LoggingConfigurable
 
-from .utils import Cache
+from .utils import Cache, TTLCache
+
+try:
+    # orjson parses bytes directly and is considerably faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 GITHUB_RATE_LIMIT = Gauge('binderhub_github_rate_limit_remaining', 'GitHub rate limit remaining')
+GITHUB_LS_REMOTE_FALLBACK = Counter(
+    'binderhub_github_ls_remote_fallback_count',
+    'Refs resolved with git ls-remote because the GitHub rate limit was exceeded',
+    ['status'],
+)
 SHA1_PATTERN = re.compile(r'[0-9a-f]{40}')
 
 
@@ -33,21 +46,163 @@ def tokenize_spec(spec):
     """Tokenize a GitHub-style spec into parts, error if spec invalid."""
 
     spec_parts = spec.split('/', 2)  # allow ref to contain "/"
-    if len(spec_parts) != 3:
+    if len(spec_parts) != 3 or not all(spec_parts):
         msg = 'Spec is not of the form "user/repo/ref", provided: "{spec}".'.format(spec=spec)
-        if len(spec_parts) == 2 and spec_parts[-1] != 'master':
+        if len(spec_parts) == 2 and all(spec_parts) and spec_parts[-1] != 'master':
             msg += ' Did you mean "{spec}/master"?'.format(spec=spec)
         raise ValueError(msg)
 
     return spec_parts
 
 
+# a JSON object whose first key is a sha1 "sha", as returned by the GitHub API
+_LEADING_SHA_PATTERN = re.compile(rb'\s*\{\s*"sha"\s*:\s*"([0-9a-f]{40})"')
+
+
+def _extract_sha(body):
+    """Extract the top-level "sha" from a GitHub API response body
+
+    Only looks at the start of the body, without parsing the whole
+    commit object. Returns None if the body does not start with a "sha" key,
+    in which case the caller should parse the body.
+    """
+    match = _LEADING_SHA_PATTERN.match(body)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+
+class GitHubRateLimitExceeded(ValueError):
+    """Raised when the GitHub API rate limit has been exceeded"""
+
+
+def parse_ls_remote(output, ref):
+    """Find the commit sha of ref in the output of `git ls-remote`
+
+    Only exact matches count, preferring tags (peeled to the tagged commit)
+    over branches, the same way git resolves an ambiguous name.
+    Returns None if ref is not found.
+    """
+    shas = {}
+    for line in output.splitlines():
+        sha, _, name = line.partition('\t')
+        shas[name] = sha
+    for name in (
+        'refs/tags/{}^{{}}'.format(ref),
+        'refs/tags/{}'.format(ref),
+        'refs/heads/{}'.format(ref),
+        ref,
+    ):
+        if name in shas:
+            return shas[name]
+    return None
+
+
 def strip_suffix(text, suffix):
     if text.endswith(suffix):
         text = text[:-(len(suffix))]
     return text
 
 
+# sentinel for refs missing from a provider's ref_cache
+_not_cached = object()
+
+
+def cache_resolved_ref(get_resolved_ref):
+    """Decorator caching a provider's resolved ref in its ref_cache
+
+    Repeated launches of the same spec within the cache ttl skip the
+    HTTP round-trip. Refs that could not be resolved (None) are cached
+    for ref_cache_negative_ttl only, so newly-pushed refs show up quickly.
+    """
+    @wraps(get_resolved_ref)
+    async def cached_get_resolved_ref(self):
+        key = (self.name, self.spec)
+        ref = self.ref_cache.get(key, _not_cached)
+        if ref is not _not_cached:
+            self.log.debug("Using cached ref for %s: %s", self.spec, ref)
+            self.resolved_ref = ref
+            return ref
+
+        ref = await get_resolved_ref(self)
+        if ref is None:
+            self.ref_cache.set(key, ref, ttl=self.ref_cache_negative_ttl)
+        else:
+            self.ref_cache.set(key, ref)
+        return ref
+
+    return cached_get_resolved_ref
+
+
+# Providers, and with them their config, are created for every request.
+# Compiled spec patterns are cached on the pattern contents so that
+# each configuration is only compiled once.
+
+# Global inline flags, named groups and (numbered or named) backreferences
+# change meaning or fail when patterns are joined into one alternation.
+_UNCOMBINABLE_PATTERN = re.compile(r'\(\?[aiLmsux]+\)|\(\?P[<=]|\\[1-9]|\\g<')
+
+
+@lru_cache(maxsize=32)
+def _compile_spec_patterns(trait_name, patterns):
+    """Compile a tuple of spec regexes for ``any(p.match(spec) for p in ...)``
+
+    Where possible the patterns are joined into a single alternation,
+    so matching is a single regex call. Patterns that can't safely be
+    joined are kept as individually compiled patterns instead.
+    Patterns that fail to compile are logged and skipped.
+    """
+    # Ignore case, because most git providers do not
+    # count DS-100/textbook as different from ds-100/textbook
+    compiled = []
+    for pattern in patterns:
+        try:
+            compiled.append(re.compile(pattern, re.IGNORECASE))
+        except re.error as e:
+            app_log.error("Ignoring invalid regex %r in %s: %s", pattern, trait_name, e)
+    if len(compiled) < 2 or any(_UNCOMBINABLE_PATTERN.search(p.pattern) for p in compiled):
+        return tuple(compiled)
+    try:
+        combined = re.compile(
+            '|'.join('(?:{})'.format(p.pattern) for p in compiled), re.IGNORECASE
+        )
+    except re.error:
+        return tuple(compiled)
+    return (combined,)
+
+
+# compiled spec_config lists, keyed on their repr since config dicts aren't hashable
+_compiled_spec_configs = Cache(32)
+
+
+def _compile_spec_config(spec_config):
+    """Validate spec_config and compile its patterns
+
+    Returns a list of (compiled pattern, config dict) pairs.
+    """
+    key = repr(spec_config)
+    compiled = _compiled_spec_configs.get(key)
+    if compiled is not None:
+        return compiled
+    compiled = []
+    for item in spec_config:
+        pattern = item.get('pattern', None)
+        config = item.get('config', None)
+        if not isinstance(pattern, str):
+            raise ValueError(
+                "Spec-pattern configuration expected "
+                "a regex pattern string, not "
+                "type %s" % type(pattern))
+        if not isinstance(config, dict):
+            raise ValueError(
+                "Spec-pattern configuration expected "
+                "a specification configuration dict, not "
+                "type %s" % type(config))
+        compiled.append((re.compile(pattern, re.IGNORECASE), config))
+    _compiled_spec_configs.set(key, compiled)
+    return compiled
+
+
 class RepoProvider(LoggingConfigurable):
     """Base class for a repo provider"""
     name = Unicode(
@@ -97,6 +252,9 @@ class RepoProvider(LoggingConfigurable):
 
     unresolved_ref = Unicode()
 
+    # set by get_resolved_ref once the ref has been resolved
+    resolved_ref = None
+
     git_credentials = Unicode(
         "",
         help="""
@@ -104,27 +262,68 @@ class RepoProvider(LoggingConfigurable):
         """,
     )
 
+    auth = Dict(
+        help="""Auth parameters for the provider's API, if any
+
+        Populated by providers that authenticate API requests.
+        """
+    )
+
+    auth_qs = Unicode(
+        help="""The urlencoded auth parameters
+
+        Encoded once for all API requests.
+        """
+    )
+    @default('auth_qs')
+    def _default_auth_qs(self):
+        return urllib.parse.urlencode(self.auth)
+
+    @observe('auth')
+    def _auth_changed(self, change):
+        self.auth_qs = urllib.parse.urlencode(change.new)
+
+    # requests currently in flight, shared by concurrent callers
+    _inflight = {}
+
+    # validators and values of previous responses for conditional requests,
+    # see _cacheable_fetch. Subclasses using it should have their own.
+    http_cache = Cache(1024)
+
+    # short-lived cache of resolved refs, see cache_resolved_ref
+    ref_cache = TTLCache(256, ttl=60)
+    # seconds to remember refs that could not be resolved
+    ref_cache_negative_ttl = 5
+
+    # compiled forms of banned_specs, high_quota_specs and spec_config,
+    # looked up whenever the corresponding trait changes
+    _compiled_banned = ()
+    _compiled_high_quota = ()
+    _compiled_spec_config = ()
+
+    @observe('banned_specs')
+    def _banned_specs_changed(self, change):
+        self._compiled_banned = _compile_spec_patterns('banned_specs', tuple(change.new))
+
+    @observe('high_quota_specs')
+    def _high_quota_specs_changed(self, change):
+        self._compiled_high_quota = _compile_spec_patterns('high_quota_specs', tuple(change.new))
+
+    @observe('spec_config')
+    def _spec_config_changed(self, change):
+        self._compiled_spec_config = _compile_spec_config(change.new)
+
     def is_banned(self):
         """
         Return true if the given spec has been banned
         """
-        for banned in self.banned_specs:
-            # Ignore case, because most git providers do not
-            # count DS-100/textbook as different from ds-100/textbook
-            if re.match(banned, self.spec, re.IGNORECASE):
-                return True
-        return False
+        return any(pattern.match(self.spec) for pattern in self._compiled_banned)
 
     def has_higher_quota(self):
         """
         Return true if the given spec has a higher quota
         """
-        for higher_quota in self.high_quota_specs:
-            # Ignore case, because most git providers do not
-            # count DS-100/textbook as different from ds-100/textbook
-            if re.match(higher_quota, self.spec, re.IGNORECASE):
-                return True
-        return False
+        return any(pattern.match(self.spec) for pattern in self._compiled_high_quota)
 
     def repo_config(self, settings):
         """
@@ -139,27 +338,82 @@ class RepoProvider(LoggingConfigurable):
             repo_config['quota'] = settings.get('per_repo_quota')
 
         # Spec regex-based configuration
-        for item in self.spec_config:
-            pattern = item.get('pattern', None)
-            config = item.get('config', None)
-            if not isinstance(pattern, str):
-                raise ValueError(
-                    "Spec-pattern configuration expected "
-                    "a regex pattern string, not "
-                    "type %s" % type(pattern))
-            if not isinstance(config, dict):
-                raise ValueError(
-                    "Spec-pattern configuration expected "
-                    "a specification configuration dict, not "
-                    "type %s" % type(config))
-            # Ignore case, because most git providers do not
-            # count DS-100/textbook as different from ds-100/textbook
-            if re.match(pattern, self.spec, re.IGNORECASE):
+        for pattern, config in self._compiled_spec_config:
+            if pattern.match(self.spec):
                 repo_config.update(config)
         return repo_config
 
-    @gen.coroutine
-    def get_resolved_ref(self):
+    def _collapse_request(self, key, fetch):
+        """Collapse concurrent identical requests into one
+
+        Call ``fetch()`` only if no request for ``key`` is already in flight,
+        and return a Future for its result that every caller can wait on.
+        The entry is dropped as soon as the request finishes,
+        so later requests always go back to the network.
+
+        Each caller gets the shared request wrapped in ``asyncio.shield``,
+        so cancelling one caller doesn't cancel it for the others.
+        """
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._inflight[key] = future
+
+            def _done(f):
+                if self._inflight.get(key) is f:
+                    del self._inflight[key]
+
+            future.add_done_callback(_done)
+        return asyncio.shield(future)
+
+    async def _cacheable_fetch(self, url, key=None, **kwargs):
+        """Fetch a url with a conditional GET
+
+        If a previous response for ``key`` (default: url) was stored with
+        ``_cache_response``, its ETag and Last-Modified are sent as
+        If-None-Match and If-Modified-Since.
+
+        Returns ``(response, cached)`` where cached is the stored entry
+        (a dict with etag, last_modified and value) or None.
+        response is None if the server replied 304 Not Modified,
+        in which case ``cached['value']`` is still valid.
+        """
+        if key is None:
+            key = url
+        cached = self.http_cache.get(key)
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        req = HTTPRequest(url, headers=headers, user_agent="BinderHub", **kwargs)
+        try:
+            resp = await AsyncHTTPClient().fetch(req)
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            resp = e.response
+        if resp.code == 304:
+            self.log.debug("Not modified: %s", key)
+            return None, cached
+        return resp, cached
+
+    def _cache_response(self, key, resp, value):
+        """Store the value computed from a response for later conditional requests
+
+        Responses without an ETag or Last-Modified header are not stored.
+        """
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.http_cache.set(key, {
+                'etag': etag,
+                'last_modified': last_modified,
+                'value': value,
+            })
+
+    async def get_resolved_ref(self):
         raise NotImplementedError("Must be overridden in child class")
 
     def get_repo_url(self):
@@ -172,7 +426,7 @@ class RepoProvider(LoggingConfigurable):
 
     @staticmethod
     def sha1_validate(sha1):
-        if not SHA1_PATTERN.match(sha1):
+        if not SHA1_PATTERN.fullmatch(sha1):
             raise ValueError("resolved_ref is not a valid sha1 hexadecimal hash")
 
 
@@ -197,14 +451,23 @@ class ZenodoProvider(RepoProvider):
     """
     name = Unicode("Zenodo")
 
-    @gen.coroutine
-    def get_resolved_ref(self):
-        client = AsyncHTTPClient()
-        req = HTTPRequest("https://doi.org/{}".format(self.spec),
-                          user_agent="BinderHub")
-        r = yield client.fetch(req)
-        self.record_id = r.effective_url.rsplit("/", maxsplit=1)[1]
-        return self.record_id
+    ref_cache = TTLCache(256, ttl=60)
+    http_cache = Cache(1024)
+
+    @property
+    def record_id(self):
+        return self.resolved_ref
+
+    @cache_resolved_ref
+    async def get_resolved_ref(self):
+        url = "https://doi.org/{}".format(self.spec)
+        r, cached = await self._collapse_request(url, lambda: self._cacheable_fetch(url))
+        if r is None:
+            self.resolved_ref = cached['value']
+            return self.resolved_ref
+        self.resolved_ref = r.effective_url.rsplit("/", maxsplit=1)[1]
+        self._cache_response(url, r, self.resolved_ref)
+        return self.resolved_ref
 
     def get_repo_url(self):
         # While called repo URL, the return value of this function is passed
@@ -241,8 +504,7 @@ class GitRepoProvider(RepoProvider):
         self.resolved_ref = resolved_ref
         self.unresolved_ref = resolved_ref
 
-    @gen.coroutine
-    def get_resolved_ref(self):
+    async def get_resolved_ref(self):
         return self.resolved_ref
 
     def get_repo_url(self):
@@ -315,6 +577,9 @@ class GitLabRepoProvider(RepoProvider):
             return r'username=binderhub\npassword={token}'.format(token=self.private_token)
         return ""
 
+    ref_cache = TTLCache(256, ttl=60)
+    http_cache = Cache(1024)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         quoted_namespace, unresolved_ref = self.spec.split('/', 1)
@@ -322,52 +587,196 @@ class GitLabRepoProvider(RepoProvider):
         self.unresolved_ref = urllib.parse.unquote(unresolved_ref)
         if not self.unresolved_ref:
             raise ValueError("An unresolved ref is required")
+        self._quoted_namespace = urllib.parse.quote(self.namespace, safe='')
+        self._quoted_ref = urllib.parse.quote(self.unresolved_ref, safe='')
+        self._repo_url = "https://{hostname}/{namespace}.git".format(
+            hostname=self.hostname, namespace=self.namespace)
+        # escape the name and replace dashes with something else.
+        # dashes must be escaped before slashes become dashes.
+        self._build_slug = self.namespace.replace('-', '_-').replace('/', '-')
 
-    @gen.coroutine
-    def get_resolved_ref(self):
-        if hasattr(self, 'resolved_ref'):
+    @cache_resolved_ref
+    async def get_resolved_ref(self):
+        if self.resolved_ref is not None:
             return self.resolved_ref
 
-        namespace = urllib.parse.quote(self.namespace, safe='')
-        client = AsyncHTTPClient()
         api_url = "https://{hostname}/api/v4/projects/{namespace}/repository/commits/{ref}".format(
             hostname=self.hostname,
-            namespace=namespace,
-            ref=urllib.parse.quote(self.unresolved_ref, safe=''),
+            namespace=self._quoted_namespace,
+            ref=self._quoted_ref,
         )
         self.log.debug("Fetching %s", api_url)
 
-        if self.auth:
+        # key on the url without auth params
+        key = api_url
+        if self.auth_qs:
             # Add auth params. After logging!
-            api_url = url_concat(api_url, self.auth)
+            api_url += ('&' if '?' in api_url else '?') + self.auth_qs
 
         try:
-            resp = yield client.fetch(api_url, user_agent="BinderHub")
+            resp, cached = await self._collapse_request(
+                key, lambda: self._cacheable_fetch(api_url, key=key)
+            )
         except HTTPError as e:
             if e.code == 404:
                 return None
             else:
                 raise
 
-        ref_info = json.loads(resp.body.decode('utf-8'))
+        if resp is None:
+            self.log.info("Using cached ref for %s: %s", key, cached['value'])
+            self.resolved_ref = cached['value']
+            return self.resolved_ref
+
+        ref_info = json_loads(resp.body)
         self.resolved_ref = ref_info['id']
+        self._cache_response(key, resp, self.resolved_ref)
         return self.resolved_ref
 
     def get_build_slug(self):
-        # escape the name and replace dashes with something else.
-        return '-'.join(p.replace('-', '_-') for p in self.namespace.split('/'))
+        return self._build_slug
 
     def get_repo_url(self):
-        return "https://{hostname}/{namespace}.git".format(
-            hostname=self.hostname, namespace=self.namespace)
+        return self._repo_url
+
+
+class GitHubBatcher:
+    """Resolve many GitHub refs with a single GraphQL query
+
+    Refs submitted with ``resolve`` are collected for up to ``batch_window``
+    seconds, or until ``max_batch_size`` refs are pending, and then resolved
+    together with one request to the GitHub GraphQL API.
+    The GraphQL API requires authentication with an access token.
+    """
+
+    # one batcher per GraphQL endpoint and access token
+    _instances = {}
+
+    @classmethod
+    def instance(cls, graphql_url, access_token, **kwargs):
+        """Return the shared batcher for a GraphQL endpoint and token"""
+        key = (graphql_url, access_token)
+        if key not in cls._instances:
+            cls._instances[key] = cls(graphql_url, access_token, **kwargs)
+        return cls._instances[key]
+
+    def __init__(self, graphql_url, access_token, batch_window=0.25, max_batch_size=20):
+        self.graphql_url = graphql_url
+        self.access_token = access_token
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        # list of (owner, name, ref, future)
+        self._pending = []
+        self._flush_handle = None
+
+    def resolve(self, owner, name, ref):
+        """Return a Future for the commit sha of ref, or None if not found"""
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((owner, name, ref, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_pending()
+        elif self._flush_handle is None:
+            self._flush_handle = IOLoop.current().call_later(
+                self.batch_window, self._flush_pending
+            )
+        return future
+
+    def _flush_pending(self):
+        loop = IOLoop.current()
+        if self._flush_handle is not None:
+            loop.remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        loop.spawn_callback(self._flush, batch)
+
+    @staticmethod
+    def _build_query(batch):
+        """Build a GraphQL query and its variables for a batch of refs"""
+        params = []
+        fields = []
+        variables = {}
+        for i, (owner, name, ref, future) in enumerate(batch):
+            params.append("$o{i}: String!, $n{i}: String!, $e{i}: String!".format(i=i))
+            fields.append(
+                "r{i}: repository(owner: $o{i}, name: $n{i}) {{ "
+                "object(expression: $e{i}) {{ "
+                "... on Commit {{ oid }} "
+                "... on Tag {{ target {{ oid }} }} "
+                "}} }}".format(i=i)
+            )
+            variables.update({
+                'o%i' % i: owner,
+                'n%i' % i: name,
+                'e%i' % i: ref,
+            })
+        query = "query({params}) {{ {fields} }}".format(
+            params=", ".join(params), fields=" ".join(fields),
+        )
+        return query, variables
+
+    @staticmethod
+    def _check_response(result):
+        """Return the data of a GraphQL response, raise if the query failed
+
+        GitHub reports failures such as rate limiting as a 200 response
+        with ``errors``. Only NOT_FOUND errors (missing repositories)
+        are expected, those repositories are null in the data.
+        """
+        data = result.get('data')
+        errors = result.get('errors') or []
+        failed = [e for e in errors if e.get('type') != 'NOT_FOUND']
+        if data is None or failed:
+            failed = failed or errors
+            message = "GitHub GraphQL query failed: {}".format(
+                "; ".join(e.get('message', str(e)) for e in failed) or "no data"
+            )
+            if any(e.get('type') == 'RATE_LIMITED' for e in failed):
+                raise GitHubRateLimitExceeded(message)
+            raise ValueError(message)
+        return data
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        query, variables = self._build_query(batch)
+        req = HTTPRequest(
+            self.graphql_url,
+            method="POST",
+            body=json.dumps({'query': query, 'variables': variables}),
+            headers={'Authorization': 'bearer {}'.format(self.access_token)},
+            user_agent="BinderHub",
+        )
+        app_log.debug("Resolving %i GitHub refs with %s", len(batch), self.graphql_url)
+        try:
+            resp = await AsyncHTTPClient().fetch(req)
+            data = self._check_response(json_loads(resp.body))
+        except Exception as e:
+            for owner, name, ref, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for i, (owner, name, ref, future) in enumerate(batch):
+            # missing repositories and refs are null in the response
+            obj = (data.get('r%i' % i) or {}).get('object') or {}
+            if 'target' in obj:
+                # annotated tag, resolve to the tagged commit
+                obj = obj['target'] or {}
+            if not future.done():
+                future.set_result(obj.get('oid'))
 
 
 class GitHubRepoProvider(RepoProvider):
     """Repo provider for the GitHub service"""
     name = Unicode('GitHub')
 
-    # shared cache for resolved refs
-    cache = Cache(1024)
+    # shared caches for resolved refs, one per hostname
+    _cache_by_host = {}
+
+    # last rate limit remaining recorded in GITHUB_RATE_LIMIT
+    _last_rate_limit_remaining = None
+
+    ref_cache = TTLCache(256, ttl=60)
 
     hostname = Unicode('github.com',
         config=True,
@@ -377,6 +786,20 @@ class GitHubRepoProvider(RepoProvider):
         e.g. GitHub Enterprise.
         """)
 
+    cache_size = Integer(
+        4096,
+        config=True,
+        help="""Number of resolved refs (with their ETags) to cache per hostname"""
+    )
+
+    @property
+    def cache(self):
+        """The shared cache of resolved refs for this provider's hostname"""
+        cache = self._cache_by_host.get(self.hostname)
+        if cache is None:
+            cache = self._cache_by_host[self.hostname] = Cache(self.cache_size)
+        return cache
+
     client_id = Unicode(config=True,
         help="""GitHub client id for authentication with the GitHub API
 
@@ -409,6 +832,46 @@ class GitHubRepoProvider(RepoProvider):
     def _access_token_default(self):
         return os.getenv('GITHUB_ACCESS_TOKEN', '')
 
+    graphql_batching = Bool(
+        False,
+        config=True,
+        help="""Resolve refs in batches with the GitHub GraphQL API
+
+        Refs requested within graphql_batch_window of each other are
+        resolved with a single API request, saving rate limit under
+        many concurrent launches.
+        Requires access_token, ignored otherwise.
+        """
+    )
+
+    graphql_batch_window = Float(
+        0.25,
+        config=True,
+        help="""Seconds to collect refs before resolving them as a batch"""
+    )
+
+    graphql_max_batch_size = Integer(
+        20,
+        config=True,
+        help="""Maximum number of refs to resolve in a single GraphQL request"""
+    )
+
+    ls_remote_fallback = Bool(
+        True,
+        config=True,
+        help="""Resolve branches and tags with `git ls-remote` when the GitHub rate limit is exceeded
+
+        Keeps launches working while the API quota is exhausted,
+        at the cost of running git locally.
+        """
+    )
+
+    ls_remote_timeout = Float(
+        30,
+        config=True,
+        help="""Timeout (in seconds) for `git ls-remote` when falling back on it"""
+    )
+
     auth = Dict(
         help="""Auth parameters for the GitHub API access
 
@@ -441,25 +904,37 @@ class GitHubRepoProvider(RepoProvider):
         super().__init__(*args, **kwargs)
         self.user, self.repo, self.unresolved_ref = tokenize_spec(self.spec)
         self.repo = strip_suffix(self.repo, ".git")
+        self._repo_url = "https://{hostname}/{user}/{repo}".format(
+            hostname=self.hostname, user=self.user, repo=self.repo)
+        self._build_slug = '{user}-{repo}'.format(user=self.user, repo=self.repo)
 
     def get_repo_url(self):
-        return "https://{hostname}/{user}/{repo}".format(
-            hostname=self.hostname, user=self.user, repo=self.repo)
+        return self._repo_url
 
-    @gen.coroutine
     def github_api_request(self, api_url, etag=None):
+        """Make a GitHub API request
+
+        Concurrent requests for the same url and etag share
+        a single HTTP request.
+        """
+        return self._collapse_request(
+            (api_url, etag),
+            lambda: self._github_api_request(api_url, etag=etag),
+        )
+
+    async def _github_api_request(self, api_url, etag=None):
         client = AsyncHTTPClient()
-        if self.auth:
+        if self.auth_qs:
             # Add auth params. After logging!
-            api_url = url_concat(api_url, self.auth)
-
-        headers = {}
-        if etag:
-            headers['If-None-Match'] = etag
-        req = HTTPRequest(api_url, headers=headers, user_agent="BinderHub")
+            api_url += ('&' if '?' in api_url else '?') + self.auth_qs
 
         try:
-            resp = yield client.fetch(req)
+            if etag:
+                resp = await client.fetch(
+                    api_url, headers={'If-None-Match': etag}, user_agent="BinderHub"
+                )
+            else:
+                resp = await client.fetch(api_url, user_agent="BinderHub")
         except HTTPError as e:
             if e.code == 304:
                 resp = e.response
@@ -480,7 +955,8 @@ class GitHubRepoProvider(RepoProvider):
                 # round expiry up to nearest 5 minutes
                 minutes_until_reset = 5 * (1 + (reset_seconds // 60 // 5))
 
-                raise ValueError("GitHub rate limit exceeded. Try again in %i minutes."
+                raise GitHubRateLimitExceeded(
+                    "GitHub rate limit exceeded. Try again in %i minutes."
                     % minutes_until_reset
                 )
             # Status 422 is returned by the API when we try and resolve a non
@@ -495,8 +971,10 @@ class GitHubRepoProvider(RepoProvider):
         rate_limit = int(resp.headers['x-ratelimit-limit'])
         reset_timestamp = int(resp.headers['x-ratelimit-reset'])
 
-        # record with prometheus
-        GITHUB_RATE_LIMIT.set(remaining)
+        # record with prometheus, only when it changed
+        if remaining != GitHubRepoProvider._last_rate_limit_remaining:
+            GitHubRepoProvider._last_rate_limit_remaining = remaining
+            GITHUB_RATE_LIMIT.set(remaining)
 
         # log at different levels, depending on remaining fraction
         fraction = remaining / rate_limit
@@ -514,9 +992,24 @@ class GitHubRepoProvider(RepoProvider):
         ))
         return resp
 
-    @gen.coroutine
-    def get_resolved_ref(self):
-        if hasattr(self, 'resolved_ref'):
+    @cache_resolved_ref
+    async def get_resolved_ref(self):
+        if self.resolved_ref is not None:
+            return self.resolved_ref
+
+        if self.graphql_batching and self.access_token:
+            batcher = GitHubBatcher.instance(
+                "https://api.{hostname}/graphql".format(hostname=self.hostname),
+                self.access_token,
+                batch_window=self.graphql_batch_window,
+                max_batch_size=self.graphql_max_batch_size,
+            )
+            try:
+                self.resolved_ref = await batcher.resolve(
+                    self.user, self.repo, self.unresolved_ref
+                )
+            except GitHubRateLimitExceeded as e:
+                self.resolved_ref = await self._ls_remote_fallback(e)
             return self.resolved_ref
 
         api_url = "https://api.{hostname}/repos/{user}/{repo}/commits/{ref}".format(
@@ -531,7 +1024,11 @@ class GitHubRepoProvider(RepoProvider):
         else:
             etag = None
 
-        resp = yield self.github_api_request(api_url, etag=etag)
+        try:
+            resp = await self.github_api_request(api_url, etag=etag)
+        except GitHubRateLimitExceeded as e:
+            self.resolved_ref = await self._ls_remote_fallback(e)
+            return self.resolved_ref
         if resp is None:
             return None
         if resp.code == 304:
@@ -543,14 +1040,19 @@ class GitHubRepoProvider(RepoProvider):
         elif cached:
             self.log.debug("Cache outdated for %s", api_url)
 
-        ref_info = json.loads(resp.body.decode('utf-8'))
-        if 'sha' not in ref_info:
-            # TODO: Figure out if we should raise an exception instead?
-            self.log.warning("No sha for %s in %s", api_url, ref_info)
-            self.resolved_ref = None
-            return None
+        sha = None
+        if resp.headers.get('content-type', '').startswith('application/json'):
+            sha = _extract_sha(resp.body)
+        if sha is None:
+            ref_info = json_loads(resp.body)
+            if 'sha' not in ref_info:
+                # TODO: Figure out if we should raise an exception instead?
+                self.log.warning("No sha for %s in %s", api_url, ref_info)
+                self.resolved_ref = None
+                return None
+            sha = ref_info['sha']
         # store resolved ref and cache for later
-        self.resolved_ref = ref_info['sha']
+        self.resolved_ref = sha
         self.cache.set(
             api_url,
             {
@@ -560,8 +1062,76 @@ class GitHubRepoProvider(RepoProvider):
         )
         return self.resolved_ref
 
+    async def _ls_remote_fallback(self, error):
+        """Resolve unresolved_ref with `git ls-remote` after hitting the rate limit
+
+        Raises error, the GitHubRateLimitExceeded, again
+        if the fallback is disabled or the ref could not be resolved.
+        """
+        if not self.ls_remote_fallback:
+            raise error
+        sha = await self.ls_remote_resolve()
+        if sha is None:
+            raise error
+        return sha
+
+    async def ls_remote_resolve(self):
+        """Resolve unresolved_ref with `git ls-remote`, without using the API
+
+        Returns None if the ref could not be resolved this way.
+        """
+        try:
+            # a full sha can't be listed by ls-remote, but needs no resolving
+            self.sha1_validate(self.unresolved_ref)
+        except ValueError:
+            pass
+        else:
+            return self.unresolved_ref
+
+        repo_url = self.get_repo_url()
+        # concurrent launches hitting the rate limit share one subprocess
+        return await self._collapse_request(
+            ('ls-remote', repo_url, self.unresolved_ref),
+            lambda: self._ls_remote(repo_url, self.unresolved_ref),
+        )
+
+    async def _ls_remote(self, repo_url, ref):
+        self.log.warning("Resolving %s in %s with git ls-remote", ref, repo_url)
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                # the second pattern lists annotated tags peeled to their commit
+                'git', 'ls-remote', repo_url, ref, ref + '^{}',
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+                # fail instead of asking for credentials of private repos
+                env=dict(os.environ, GIT_TERMINAL_PROMPT='0'),
+            )
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(), self.ls_remote_timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
+        except (OSError, asyncio.TimeoutError) as e:
+            self.log.error("git ls-remote %s failed: %s", repo_url, e)
+            GITHUB_LS_REMOTE_FALLBACK.labels(status='failure').inc()
+            return None
+
+        sha = None
+        if proc.returncode == 0:
+            sha = parse_ls_remote(stdout.decode('utf-8', 'replace'), ref)
+        if sha is not None:
+            try:
+                self.sha1_validate(sha)
+            except ValueError:
+                sha = None
+        GITHUB_LS_REMOTE_FALLBACK.labels(
+            status='failure' if sha is None else 'success'
+        ).inc()
+        return sha
+
     def get_build_slug(self):
-        return '{user}-{repo}'.format(user=self.user, repo=self.repo)
+        return self._build_slug
 
 
 class GistRepoProvider(GitHubRepoProvider):
@@ -579,6 +1149,8 @@ class GistRepoProvider(GitHubRepoProvider):
 
     name = Unicode('Gist')
 
+    ref_cache = TTLCache(256, ttl=60)
+
     allow_secret_gist = Bool(
         default_value=False,
         config=True,
@@ -598,30 +1170,31 @@ class GistRepoProvider(GitHubRepoProvider):
     def get_repo_url(self):
         return f'https://gist.github.com/{self.user}/{self.gist_id}.git'
 
-    @gen.coroutine
-    def get_resolved_ref(self):
-        if hasattr(self, 'resolved_ref'):
+    @cache_resolved_ref
+    async def get_resolved_ref(self):
+        if self.resolved_ref is not None:
             return self.resolved_ref
 
         api_url = f"https://api.github.com/gists/{self.gist_id}"
         self.log.debug("Fetching %s", api_url)
 
-        resp = yield self.github_api_request(api_url)
+        resp = await self.github_api_request(api_url)
         if resp is None:
             return None
 
-        ref_info = json.loads(resp.body.decode('utf-8'))
+        ref_info = json_loads(resp.body)
 
         if (not self.allow_secret_gist) and (not ref_info['public']):
             raise ValueError("You seem to want to use a secret Gist, but do not have permission to do so. "
                              "To enable secret Gist support, set (or have an administrator set) "
                              "'GistRepoProvider.allow_secret_gist = True'")
 
-        all_versions = [e['version'] for e in ref_info['history']]
+        history = ref_info['history']
         if (len(self.unresolved_ref) == 0) or (self.unresolved_ref == 'master'):
-            self.resolved_ref = all_versions[0]
+            self.resolved_ref = history[0]['version']
         else:
-            if self.unresolved_ref not in all_versions:
+            # stop at the first match instead of collecting every version
+            if not any(e['version'] == self.unresolved_ref for e in history):
                 return None
             else:
                 self.resolved_ref = self.unresolved_ref
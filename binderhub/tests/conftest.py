@@ -2,6 +2,7 @@
 
 from binascii import b2a_hex
 from collections import defaultdict
+import copy
 import inspect
 import json
 import os
@@ -18,6 +19,7 @@ from tornado.platform.asyncio import AsyncIOMainLoop
 from traitlets.config.loader import PyFileConfigLoader
 
 from ..app import BinderHub
+from ..repoproviders import GitHubBatcher, RepoProvider
 from .utils import MockAsyncHTTPClient
 
 
@@ -79,6 +81,51 @@ def mock_asynchttpclient(request):
         load_mock_responses('zenodo.org')
 
 
+@pytest.fixture(autouse=True)
+def empty_repo_provider_caches(monkeypatch):
+    """Give every test empty class-level repo provider caches
+
+    Resolved refs are cached across requests,
+    so without this they would leak from one test into the next.
+    """
+    providers = [RepoProvider]
+    for cls in providers:
+        providers.extend(cls.__subclasses__())
+        for name in ('ref_cache', 'http_cache'):
+            if name in vars(cls):
+                cache = copy.copy(vars(cls)[name])
+                cache.clear()
+                monkeypatch.setattr(cls, name, cache)
+        if '_cache_by_host' in vars(cls):
+            monkeypatch.setattr(cls, '_cache_by_host', {})
+    monkeypatch.setattr(RepoProvider, '_inflight', {})
+    monkeypatch.setattr(GitHubBatcher, '_instances', {})
+
+
+@pytest.fixture
+def record_calls(monkeypatch):
+    """Record calls to a method, while still calling it
+
+    ``calls = record_calls(cls, name)`` returns a list that gets
+    the arguments of each call, as a dict of argument name to value.
+    """
+    def record(cls, name):
+        calls = []
+        method = getattr(cls, name)
+        signature = inspect.signature(method)
+
+        def recording_method(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            arguments.pop('self', None)
+            calls.append(dict(arguments))
+            return method(*args, **kwargs)
+
+        monkeypatch.setattr(cls, name, recording_method)
+        return calls
+
+    return record
+
+
 @pytest.fixture
 def io_loop(event_loop, request):
     """Same as pytest-tornado.io_loop, but runs with pytest-asyncio"""
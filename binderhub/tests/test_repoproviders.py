@@ -1,3 +1,7 @@
+import asyncio
+import json
+import subprocess
+from types import SimpleNamespace
 from unittest import TestCase
 
 from urllib.parse import quote
@@ -5,9 +9,20 @@ import pytest
 from tornado.ioloop import IOLoop
 
 from binderhub.repoproviders import (
-    tokenize_spec, strip_suffix, GitHubRepoProvider, GitRepoProvider,
-    GitLabRepoProvider, GistRepoProvider, ZenodoProvider
+    tokenize_spec, strip_suffix, _extract_sha, GitHubBatcher,
+    GitHubRepoProvider, GitRepoProvider, GitLabRepoProvider, GistRepoProvider,
+    ZenodoProvider, RepoProvider, GitHubRateLimitExceeded, parse_ls_remote,
 )
+from binderhub import utils
+from binderhub.utils import TTLCache
+from .utils import MockAsyncHTTPClient
+
+
+def resolve_all(providers):
+    """Resolve the refs of several providers concurrently"""
+    async def gather():
+        return await asyncio.gather(*(p.get_resolved_ref() for p in providers))
+    return IOLoop().run_sync(gather)
 
 
 # General string processing
@@ -22,6 +37,44 @@ def test_string_strip(raw_text, suffix, clean_text):
     assert strip_suffix(raw_text, suffix) == clean_text
 
 
+@pytest.mark.parametrize(
+    'body, sha', [
+        (b'{"sha":"f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603","node_id":"x"}',
+         'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'),
+        (b'{\n  "sha": "f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603"\n}',
+         'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'),
+        # only the top-level sha, never a nested tree or parent sha
+        (b'{"node_id":"x","tree":{"sha":"f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603"}}', None),
+        (b'{"message":"No commit found"}', None),
+    ]
+)
+def test_extract_sha(body, sha):
+    assert _extract_sha(body) == sha
+
+
+LS_REMOTE_OUTPUT = """\
+0c1b6c45bd6e6ac3a5c6a1d5d0e3c4a6fb4a2a1e\trefs/heads/master
+1111111111111111111111111111111111111111\trefs/heads/feature/v0.4
+2222222222222222222222222222222222222222\trefs/tags/v0.4
+f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603\trefs/tags/v0.4^{}
+3333333333333333333333333333333333333333\trefs/heads/v0.5
+4444444444444444444444444444444444444444\trefs/tags/v0.5
+"""
+
+
+@pytest.mark.parametrize(
+    'ref, sha', [
+        ('master', '0c1b6c45bd6e6ac3a5c6a1d5d0e3c4a6fb4a2a1e'),
+        ('v0.4', 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'),
+        ('v0.5', '4444444444444444444444444444444444444444'),
+        ('feature/v0.4', '1111111111111111111111111111111111111111'),
+        ('feature', None),
+    ]
+)
+def test_parse_ls_remote(ref, sha):
+    assert parse_ls_remote(LS_REMOTE_OUTPUT, ref) == sha
+
+
 # user/repo/reference
 @pytest.mark.parametrize(
     'spec, raw_user, raw_repo, raw_ref', [
@@ -63,6 +116,270 @@ def test_github_ref():
     assert ref == 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
 
 
+@pytest.mark.github_api
+def test_github_concurrent_requests_collapsed(record_calls):
+    api_requests = record_calls(GitHubRepoProvider, '_github_api_request')
+
+    spec = 'jupyterhub/zero-to-jupyterhub-k8s/v0.4'
+    providers = [GitHubRepoProvider(spec=spec) for i in range(3)]
+
+    refs = resolve_all(providers)
+    assert refs == ['f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'] * 3
+    assert len(api_requests) == 1
+
+
+def test_collapsed_request_cancel():
+    provider = RepoProvider()
+    started = []
+
+    async def fetch():
+        started.append(True)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def cancel_one():
+        first = provider._collapse_request('key', fetch)
+        second = provider._collapse_request('key', fetch)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert IOLoop().run_sync(cancel_one) == 'result'
+    assert started == [True]
+
+
+@pytest.mark.github_api
+def test_github_ref_cache(record_calls):
+    api_requests = record_calls(GitHubRepoProvider, '_github_api_request')
+
+    for spec, expected in [
+        ('jupyterhub/zero-to-jupyterhub-k8s/v0.4', 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'),
+        ('jupyterhub/zero-to-jupyterhub-k8s/v0.1.2.3.4.5.6', None),
+    ]:
+        for i in range(2):
+            provider = GitHubRepoProvider(spec=spec)
+            assert IOLoop().run_sync(provider.get_resolved_ref) == expected
+
+    # each spec, including the missing ref, was only looked up once
+    assert len(api_requests) == 2
+
+
+def test_github_cache_per_hostname():
+    spec = 'jupyterhub/zero-to-jupyterhub-k8s/v0.4'
+    github = GitHubRepoProvider(spec=spec, cache_size=10)
+    enterprise = GitHubRepoProvider(spec=spec, hostname='github.example.com', cache_size=10)
+    assert github.cache is GitHubRepoProvider(spec=spec).cache
+    assert github.cache is not enterprise.cache
+    assert github.cache.max_size == enterprise.cache.max_size == 10
+
+
+def test_ttl_cache(monkeypatch):
+    now = 1000
+    monkeypatch.setattr(utils, 'time', SimpleNamespace(monotonic=lambda: now))
+    cache = TTLCache(ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=5)
+    assert (cache.get('a'), cache.get('b')) == (1, 2)
+
+    now = 1005
+    assert cache.get('b', 'expired') == 'expired'
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+
+    now = 1060
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+@pytest.mark.github_api
+def test_github_ref_cache_expiry(monkeypatch, record_calls):
+    now = 1000
+    monkeypatch.setattr(utils, 'time', SimpleNamespace(monotonic=lambda: now))
+    api_requests = record_calls(GitHubRepoProvider, '_github_api_request')
+
+    def resolve(spec):
+        provider = GitHubRepoProvider(spec=spec)
+        return IOLoop().run_sync(provider.get_resolved_ref)
+
+    found = 'jupyterhub/zero-to-jupyterhub-k8s/v0.4'
+    missing = 'jupyterhub/zero-to-jupyterhub-k8s/v0.1.2.3.4.5.6'
+    resolve(found)
+    resolve(missing)
+    assert len(api_requests) == 2
+
+    # missing refs are cached for ref_cache_negative_ttl only
+    now = 1004
+    resolve(found)
+    resolve(missing)
+    assert len(api_requests) == 2
+    now = 1000 + GitHubRepoProvider.ref_cache_negative_ttl
+    assert resolve(missing) is None
+    assert len(api_requests) == 3
+
+    # resolved refs are cached for the ttl of the ref_cache
+    now = 1059
+    resolve(found)
+    assert len(api_requests) == 3
+    now = 1060
+    assert resolve(found) == 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
+    assert len(api_requests) == 4
+
+
+def test_github_graphql_batching(monkeypatch, record_calls):
+    flushes = record_calls(GitHubBatcher, '_flush')
+    monkeypatch.setitem(MockAsyncHTTPClient.mocks, 'https://api.github.com/graphql', {
+        'body': json.dumps({'data': {
+            'r0': {'object': {'oid': 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'}},
+            'r1': {'object': {'target': {'oid': 'b3344b7f17c335a817c5d7608c5e47fd7cabc023'}}},
+            'r2': {'object': None},
+            'r3': None,
+        }}),
+    })
+
+    providers = [
+        GitHubRepoProvider(spec=spec, access_token='token', graphql_batching=True)
+        for spec in [
+            'jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+            'jupyterhub/zero-to-jupyterhub-k8s/annotated-tag',
+            'jupyterhub/zero-to-jupyterhub-k8s/no-such-ref',
+            'jupyterhub/no-such-repo/master',
+        ]
+    ]
+
+    refs = resolve_all(providers)
+    assert refs == [
+        'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603',
+        'b3344b7f17c335a817c5d7608c5e47fd7cabc023',
+        None,
+        None,
+    ]
+    assert [
+        [ref for owner, name, ref, future in flush['batch']] for flush in flushes
+    ] == [['v0.4', 'annotated-tag', 'no-such-ref', 'master']]
+
+
+@pytest.fixture
+def git_repo(tmpdir):
+    """A local git repo with one commit, tagged v0.4 with an annotated tag
+
+    Returns the path of the repo and the sha of the commit.
+    """
+    repo = str(tmpdir)
+    git = ['git', '-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    subprocess.check_call(['git', 'init', '-q', repo])
+    subprocess.check_call(git + ['commit', '-q', '--allow-empty', '-m', 'first'])
+    subprocess.check_call(git + ['tag', '-a', '-m', 'tag', 'v0.4'])
+    sha = subprocess.check_output(git + ['rev-parse', 'HEAD']).decode().strip()
+    return repo, sha
+
+
+def test_github_ls_remote_fallback(monkeypatch, record_calls, git_repo):
+    repo, sha = git_repo
+
+    async def rate_limited(self, api_url, etag=None):
+        raise GitHubRateLimitExceeded("GitHub rate limit exceeded.")
+
+    monkeypatch.setattr(GitHubRepoProvider, 'github_api_request', rate_limited)
+    monkeypatch.setattr(GitHubRepoProvider, 'get_repo_url', lambda self: repo)
+
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4', ls_remote_fallback=False,
+    )
+    with pytest.raises(GitHubRateLimitExceeded):
+        IOLoop().run_sync(provider.get_resolved_ref)
+
+    # annotated tags resolve to the tagged commit
+    provider = GitHubRepoProvider(spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4')
+    assert IOLoop().run_sync(provider.get_resolved_ref) == sha
+
+    # refs that can't be found re-raise the rate limit error
+    provider = GitHubRepoProvider(spec='jupyterhub/zero-to-jupyterhub-k8s/no-such-ref')
+    with pytest.raises(GitHubRateLimitExceeded):
+        IOLoop().run_sync(provider.get_resolved_ref)
+
+    # full shas are used as-is, without running git
+    ls_remotes = record_calls(GitHubRepoProvider, '_ls_remote')
+    provider = GitHubRepoProvider(spec='jupyterhub/zero-to-jupyterhub-k8s/' + '1' * 40)
+    assert IOLoop().run_sync(provider.get_resolved_ref) == '1' * 40
+    assert ls_remotes == []
+
+    # concurrent fallbacks for the same ref share one git ls-remote
+    providers = [
+        GitHubRepoProvider(spec='jupyterhub/zero-to-jupyterhub-k8s/master')
+        for i in range(3)
+    ]
+
+    assert resolve_all(providers) == [sha] * 3
+    assert [call['ref'] for call in ls_remotes] == ['master']
+
+
+@pytest.mark.parametrize(
+    'body, error', [
+        ({'data': None, 'errors': [
+            {'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'},
+        ]}, GitHubRateLimitExceeded),
+        ({'data': {'r0': None}, 'errors': [
+            {'type': 'NOT_FOUND', 'message': 'Could not resolve to a Repository'},
+            {'type': 'MAX_NODE_LIMIT_EXCEEDED', 'message': 'Too many nodes'},
+        ]}, ValueError),
+    ]
+)
+def test_github_graphql_errors(monkeypatch, body, error):
+    monkeypatch.setattr(GitHubRepoProvider, 'ls_remote_fallback', False)
+    monkeypatch.setitem(MockAsyncHTTPClient.mocks, 'https://api.github.com/graphql', {
+        'body': json.dumps(body),
+    })
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+        access_token='token',
+        graphql_batching=True,
+    )
+    with pytest.raises(error, match="GitHub GraphQL query failed"):
+        IOLoop().run_sync(provider.get_resolved_ref)
+    # failures are not cached as unresolvable refs
+    assert len(GitHubRepoProvider.ref_cache) == 0
+
+
+def test_github_graphql_ls_remote_fallback(monkeypatch, git_repo):
+    repo, sha = git_repo
+    monkeypatch.setattr(GitHubRepoProvider, 'get_repo_url', lambda self: repo)
+    monkeypatch.setitem(MockAsyncHTTPClient.mocks, 'https://api.github.com/graphql', {
+        'body': json.dumps({'data': None, 'errors': [
+            {'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'},
+        ]}),
+    })
+    providers = [
+        GitHubRepoProvider(spec=spec, access_token='token', graphql_batching=True)
+        for spec in [
+            'jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+            'jupyterhub/zero-to-jupyterhub-k8s/master',
+        ]
+    ]
+    # every launch in the rate limited batch falls back to git ls-remote
+    assert resolve_all(providers) == [sha, sha]
+
+
+def test_auth_qs():
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+        client_id='id', client_secret='secret value',
+    )
+    assert provider.auth_qs == 'client_id=id&client_secret=secret+value'
+    provider.auth = {'access_token': 'token'}
+    assert provider.auth_qs == 'access_token=token'
+
+    provider = GitLabRepoProvider(spec='group%2Frepo/master', private_token='token')
+    assert provider.auth_qs == 'private_token=token'
+
+    # providers without API auth have no auth params
+    assert ZenodoProvider(spec='10.5281/zenodo.3242074').auth_qs == ''
+    assert GitRepoProvider(spec='{}/{}'.format(
+        quote('https://github.com/jupyterhub/zero-to-jupyterhub-k8s', safe=''),
+        'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603',
+    )).auth_qs == ''
+
+
 def test_not_banned():
     provider = GitHubRepoProvider(
         spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
@@ -120,30 +437,27 @@ def test_custom_config():
     # Not giving a string for the pattern should raise an error
     config_err_pattern = base_config.copy()
     config_err_pattern['pattern'] = 100
-    provider = GitHubRepoProvider(
-        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
-        spec_config=[config_err_pattern]
-    )
     with pytest.raises(ValueError):
-        provider.repo_config(settings)
+        GitHubRepoProvider(
+            spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+            spec_config=[config_err_pattern]
+        )
 
     # Not giving a dictionary for configuration should raise an error
     config_err_config = base_config.copy()
     config_err_config['config'] = "not a dictionary"
-    provider = GitHubRepoProvider(
-        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
-        spec_config=[config_err_config]
-    )
     with pytest.raises(ValueError):
-        provider.repo_config(settings)
+        GitHubRepoProvider(
+            spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+            spec_config=[config_err_config]
+        )
 
     # Not providing one of `pattern` or `config` should raise an error
-    provider = GitHubRepoProvider(
-        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
-        spec_config=[base_config, {"pattern": "mypattern"}]
-    )
     with pytest.raises(ValueError):
-        provider.repo_config(settings)
+        GitHubRepoProvider(
+            spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+            spec_config=[base_config, {"pattern": "mypattern"}]
+        )
 
     # Two regexes that both match should result in the *last* one being in the config
     base_config_second = {
@@ -161,6 +475,20 @@ def test_custom_config():
 
 
 
+def test_spec_patterns_compiled_once():
+    kwargs = dict(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+        banned_specs=['^yuvipanda.*'],
+        high_quota_specs=['^jupyterhub.*'],
+        spec_config=[{'pattern': '^jupyterhub.*', 'config': {'quota': 999}}],
+    )
+    first = GitHubRepoProvider(**kwargs)
+    second = GitHubRepoProvider(**kwargs)
+    assert second._compiled_banned is first._compiled_banned
+    assert second._compiled_high_quota is first._compiled_high_quota
+    assert second._compiled_spec_config is first._compiled_spec_config
+
+
 def test_not_higher_quota():
     provider = GitHubRepoProvider(
         spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
@@ -180,6 +508,37 @@ def test_ban_is_case_insensitive(ban_spec):
     assert provider.is_banned()
 
 
+def test_ban_multiple_patterns():
+    banned_specs = ['^yuvipanda.*', '[invalid', '.*/zero-to-jupyterhub-k8s/.*']
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
+        banned_specs=banned_specs,
+    )
+    assert provider.is_banned()
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/binderhub/master',
+        banned_specs=banned_specs,
+    )
+    assert not provider.is_banned()
+
+
+@pytest.mark.parametrize(
+    'banned_specs, spec', [
+        # global inline flags
+        (['^yuvipanda.*', '(?i)^foo.*'], 'foo/bar/master'),
+        # the same group name in several patterns
+        (['(?P<u>x)y.*', '(?P<u>a)a.*'], 'aa/b/c'),
+        # numbered backreferences
+        (['(x)y.*', '(a)\\1.*'], 'aa/b/c'),
+    ]
+)
+def test_ban_uncombinable_patterns(banned_specs, spec):
+    provider = GitHubRepoProvider(spec=spec, banned_specs=banned_specs)
+    assert provider.is_banned()
+    provider = GitHubRepoProvider(spec='zz/b/c', banned_specs=banned_specs)
+    assert not provider.is_banned()
+
+
 @pytest.mark.github_api
 def test_github_missing_ref():
     provider = GitHubRepoProvider(spec='jupyterhub/zero-to-jupyterhub-k8s/v0.1.2.3.4.5.6')
@@ -200,11 +559,16 @@ class TestSpecErrorHandling(TestCase):
         spec_parts = tokenize_spec(spec)
         assert len(spec_parts) == 3
 
+    def test_spec_with_empty_parts(self):
+        for spec in ["/repo/master", "user//master", "user/repo/", "user/"]:
+            with self.assertRaisesRegexp(ValueError, "Spec is not of the form"):
+                user, repo, unresolved_ref = tokenize_spec(spec)
+
     def test_spec_with_no_suggestion(self):
-        spec = "short/master"
-        error = "^((?!Did you mean).)*$".format(spec)  # negative match
-        with self.assertRaisesRegexp(ValueError, error):
-            user, repo, unresolved_ref = tokenize_spec(spec)
+        for spec in ["short/master", "user/", "/repo"]:
+            error = "^((?!Did you mean).)*$"  # negative match
+            with self.assertRaisesRegexp(ValueError, error):
+                user, repo, unresolved_ref = tokenize_spec(spec)
 
     def test_spec_with_suggestion(self):
         spec = "short/suggestion"
@@ -228,6 +592,23 @@ def test_git_ref():
     assert ref == 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
 
 
+@pytest.mark.parametrize('sha1, valid', [
+    ('f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603', True),
+    ('0123456789012345678901234567890123456789', True),
+    ('F7F3FF6D1BF708BDC12E5F10E18B2A90A4795603', False),
+    ('f7f3ff6d1bf708bdc12e5f10e18b2a90a479560', False),
+    ('f7f3ff6d1bf708bdc12e5f10e18b2a90a47956033', False),
+    ('g7f3ff6d1bf708bdc12e5f10e18b2a90a4795603', False),
+    ('f7 3ff6d1bf708bdc12e5f10e18b2a90a4795603', False),
+])
+def test_sha1_validate(sha1, valid):
+    if valid:
+        RepoProvider.sha1_validate(sha1)
+    else:
+        with pytest.raises(ValueError):
+            RepoProvider.sha1_validate(sha1)
+
+
 def test_gitlab_ref():
     spec = '{}/{}'.format(
         quote('gitlab-org/gitlab-ce', safe=''),
@@ -242,6 +623,28 @@ def test_gitlab_ref():
     assert ref == 'b3344b7f17c335a817c5d7608c5e47fd7cabc023'
 
 
+def test_gitlab_conditional_request(monkeypatch, record_calls):
+    sha = 'b3344b7f17c335a817c5d7608c5e47fd7cabc023'
+    api_url = 'https://gitlab.com/api/v4/projects/gitlab-org%2Fgitlab-ce/repository/commits/v10.0.6'
+    monkeypatch.setitem(MockAsyncHTTPClient.mocks, api_url, {
+        'headers': {'ETag': '"abc"'},
+        'body': json.dumps({'id': sha}),
+    })
+    spec = '{}/{}'.format(quote('gitlab-org/gitlab-ce', safe=''), quote('v10.0.6'))
+
+    provider = GitLabRepoProvider(spec=spec)
+    assert IOLoop().run_sync(provider.get_resolved_ref) == sha
+
+    # only the ref cache expires, the response stays in the http cache
+    GitLabRepoProvider.ref_cache.clear()
+    fetches = record_calls(MockAsyncHTTPClient, 'fetch_mock')
+    monkeypatch.setitem(MockAsyncHTTPClient.mocks, api_url, {'code': 304, 'body': ''})
+
+    provider = GitLabRepoProvider(spec=spec)
+    assert IOLoop().run_sync(provider.get_resolved_ref) == sha
+    assert fetches[0]['request'].headers['If-None-Match'] == '"abc"'
+
+
 @pytest.mark.github_api
 def test_gist_ref():
     spec = '{}/{}'.format('mariusvniekerk', '8a658f7f63b13768d1e75fa2464f5092')
@@ -1,5 +1,7 @@
 """Miscellaneous utilities"""
 from collections import OrderedDict
+import time
+
 from traitlets import Integer, TraitError
 
 
@@ -75,6 +77,39 @@ class Cache(OrderedDict):
             self.pop(first_key)
 
 
+class TTLCache(Cache):
+    """LRU Cache whose items expire after a time-to-live
+
+    Items are stored as (value, expires_at) tuples.
+    """
+    def __init__(self, max_size=1024, ttl=60):
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        """Get an item from the cache
+
+        same as dict.get, but expired items are removed and count as missing
+        """
+        item = super().get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            self.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store an item in the cache
+
+        ttl overrides the default time-to-live for this item
+        """
+        if ttl is None:
+            ttl = self.ttl
+        super().set(key, (value, time.monotonic() + ttl))
+
+
 def url_path_join(*pieces):
     """Join components of url into a relative url.
 